@@ -26,136 +26,255 @@
 
 """Process strace output for flamegraph."""
 
-from collections import defaultdict, namedtuple
-import copy
-from datetime import datetime, timedelta
+import array
+import codecs
+from collections import namedtuple
+import mmap
+import os
+import re
 import sys
+import time
 
 
 Call = namedtuple("Call", "pid ts func args retcode status elapsed")
 
+# strace output is ASCII, so we parse it as bytes and skip decoding all of
+# it. Only the args of exec'd processes are decoded, when we render them.
+#
+# A regular syscall line looks like
+#   func(args) = retcode[ status] <elapsed>
+# where the status (e.g. "ENOENT (No such file or directory)") is optional,
+# and the elapsed time is missing for calls which never return. strace pads
+# short calls with spaces so that the "=" lines up in a column.
+_CALL_PATTERN = (
+    rb"(\w+)\((.*)\)\s+=\s+(\S+)(?: ([^<].*?))?(?: <([\d.]+)>)?"
+    rb"(?<! <unfinished \.\.\.>)$"
+)
+_CALL_RE = re.compile(_CALL_PATTERN)
+_EXITED_RE = re.compile(rb"\+\+\+ exited with (-?\d+) \+\+\+$")
+_SIGNAL_RE = re.compile(rb"--- (\S+) (.*) ---$")
+_RESUMED_RE = re.compile(rb"<\.\.\. (\S+) resumed>\s*(.*)")
+# Each line of "strace -f -ttt" output is "pid timestamp body". Most bodies
+# are complete calls, so we try to pull the call's fields out in the same
+# scan, and only fall back to capturing the raw body for anything else.
+_LINE_RE = re.compile(
+    rb"^(\d+) +([\d.]+) +(?:%s|(.*\S))" % _CALL_PATTERN,
+    re.MULTILINE,
+)
+# A C string as strace prints it, with backslash escapes.
+_QUOTED_RE = re.compile(r'"((?:[^"\\]|\\.)*)"')
+
 
 class StraceParser(object):
-    """Parse strace output into Call objects."""
+    """Parse strace output into calls."""
 
     def __init__(self):  # noqa: D107
         self.pending = {}
 
     def parse_call(self, call):
-        """Parse a single line of strace output."""
-        if call.startswith("+++ exited with "):
-            retcode = int(call[len("+++ exited with ") :].split()[0])
-            return "atexit", None, retcode, None, None
-        elif call == "+++ killed by SIGPIPE +++":
-            return "atexit", None, 128 + 13, None, None
-        elif call.startswith("--- "):
-            rest = call[len("--- ") :]
-            signal, rest = rest.split(" ", 1)
-            assert rest.endswith(" ---")
-            return "interrupt", signal, rest[:-4], None, None
+        """Parse a single line of strace output, as bytes."""
+        c = call[:1]
+        if c == b"+":
+            m = _EXITED_RE.match(call)
+            if m is not None:
+                return b"atexit", None, int(m.group(1)), None, None
+            elif call == b"+++ killed by SIGPIPE +++":
+                return b"atexit", None, 128 + 13, None, None
+        elif c == b"-":
+            m = _SIGNAL_RE.match(call)
+            if m is not None:
+                return b"interrupt", m.group(1), m.group(2), None, None
+        m = _CALL_RE.match(call)
+        if m is None:
+            raise ValueError(f"unrecognized strace output: {call!r}")
+        func, args, retcode, status, elapsed = m.groups()
+        try:
+            retcode = int(retcode)
+        except ValueError:
+            pass
+        if elapsed is None:
+            elapsed = 0.0
         else:
-            call, rest = call.rsplit(" = ", 1)
-            rest = rest.split(" ", 1)
-            try:
-                retcode = int(rest[0])
-            except ValueError:
-                retcode = rest[0]
-            if len(rest) > 1:
-                rest = rest[1].rsplit(" ", 1)
-                if len(rest) > 1:
-                    status, elapsed = rest
-                else:
-                    status = None
-                    elapsed = rest[0]
-                assert elapsed.startswith("<")
-                assert elapsed.endswith(">")
-                elapsed = timedelta(seconds=float(elapsed[1:-1]))
-            else:
-                status = None
-                elapsed = timedelta(0)
-            func = call.split("(")[0]
-            args = call[len(func) + 1 :].rsplit(")", 1)[0]
-            return func, args, retcode, status, elapsed
+            elapsed = float(elapsed)
+        return func, args, retcode, status, elapsed
 
     def parse_line(self, line):
-        """Parse a line of strace output, collapsing "unfinished" traces."""
-        s = line.split(None, 2)
-        pid = int(s[0])
-        ts = datetime.utcfromtimestamp(float(s[1]))
-        if s[2].endswith(" <unfinished ...>"):
-            assert pid not in self.pending
-            self.pending[pid] = s[2][: -len(" <unfinished ...>")]
-        elif s[2].startswith("<... "):
-            to_parse = self.pending.pop(pid)
-            rest = s[2][len("<... ") :]
-            expect_func, rest = rest.split(" ", 1)
-            assert rest.startswith("resumed>")
-            rest = rest[len("resumed>") :]
-            rest = rest.lstrip()
-            to_parse += rest
-            func, args, retcode, status, elapsed = self.parse_call(to_parse)
-            assert func == expect_func
-            return Call(
-                pid=pid,
-                ts=ts,
-                func=func,
-                args=args,
-                retcode=retcode,
-                status=status,
-                elapsed=elapsed,
-            )
-        else:
-            func, args, retcode, status, elapsed = self.parse_call(s[2])
-            return Call(
-                pid=pid,
-                ts=ts,
-                func=func,
-                args=args,
-                retcode=retcode,
-                status=status,
-                elapsed=elapsed,
-            )
-
-    def parse(self, f):
-        """Parse a file containing strace output."""
-        for line in f:
-            result = self.parse_line(line.strip())
-            if result is not None:
-                yield result
-
-
-class SyscallCounter(object):
-    """Measure the time spent during a counted number of syscalls."""
+        """Parse a line of strace output, collapsing "unfinished" traces.
 
-    def __init__(self):  # noqa: D107
-        self.calls = 0
-        self.elapsed = timedelta(0)
+        Like the rest of the parser, this works on bytes.
+
+        """
+        pid, ts, body = line.split(None, 2)
+        entry = self._parse_entry(int(pid), float(ts), body)
+        if entry is not None:
+            return Call(*entry)
+
+    def _parse_entry(self, pid, ts, body):
+        # The first character tells us which kind of line this is, which
+        # saves testing every prefix against every line.
+        c = body[:1]
+        if c == b"+" or c == b"-":
+            # Exits and signals are never split across lines.
+            return (pid, ts, *self.parse_call(body))
+        elif c == b"<":
+            m = _RESUMED_RE.match(body)
+            if m is not None:
+                expect_func, rest = m.groups()
+                to_parse = self.pending.pop(pid) + rest
+                func, args, retcode, status, elapsed = self.parse_call(
+                    to_parse
+                )
+                if func != expect_func:
+                    raise ValueError(
+                        f"pid {pid} resumed {expect_func} while {func} "
+                        "was unfinished"
+                    )
+                return pid, ts, func, args, retcode, status, elapsed
+        if body[-1:] == b">" and body.endswith(b" <unfinished ...>"):
+            if pid in self.pending:
+                raise ValueError(f"pid {pid} has two unfinished calls")
+            self.pending[pid] = body[: -len(b" <unfinished ...>")]
+            return None
+        return (pid, ts, *self.parse_call(body))
+
+    def parse_into(self, f, callback):
+        """Parse a binary file containing strace output.
+
+        The file is mapped into memory and split into lines with a single
+        regex scan, rather than being read line by line.
+
+        Rather than building a Call for each one, the fields of each call
+        are passed straight to callback, in the same order as Call's.
+
+        """
+        if os.fstat(f.fileno()).st_size == 0:
+            # mmap refuses to map empty files.
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            parse_entry = self._parse_entry
+            for m in _LINE_RE.finditer(mm):
+                pid, ts, func, args, retcode, status, elapsed, body = (
+                    m.groups()
+                )
+                if func is None:
+                    # Not a complete call, take the slow path.
+                    entry = parse_entry(int(pid), float(ts), body)
+                    if entry is not None:
+                        callback(*entry)
+                    continue
+                try:
+                    retcode = int(retcode)
+                except ValueError:
+                    pass
+                callback(
+                    int(pid),
+                    float(ts),
+                    func,
+                    args,
+                    retcode,
+                    status,
+                    0.0 if elapsed is None else float(elapsed),
+                )
+
+
+def _unquote(s):
+    """Decode the escape sequences in a string quoted by strace."""
+    if "\\" in s:
+        return codecs.decode(s, "unicode_escape")
+    return s
+
+
+# The syscalls we count time for, in the order we render them.
+_SYSCALLS = (
+    b"open",
+    b"openat",
+    b"link",
+    b"unlink",
+    b"unlinkat",
+    b"getcwd",
+    b"chdir",
+    b"mkdir",
+    b"access",
+    b"faccessat",
+    b"lstat",
+    b"stat",
+    b"newfstatat",
+    b"statfs",
+    b"readlink",
+    b"mount",
+    b"read",
+    b"write",
+    b"connect",
+    b"socket",
+    b"bind",
+    b"setsockopt",
+    b"getsockopt",
+    b"getsockname",
+    b"getpeername",
+    b"sendmmsg",
+    b"recvmsg",
+    b"recvfrom",
+    b"sendto",
+)
+_NSYSCALLS = len(_SYSCALLS)
+_SYSCALL_INDEX = {func: i for i, func in enumerate(_SYSCALLS)}
+_NO_COUNTS = array.array("d", [0.0]) * (2 * _NSYSCALLS)
+
+
+def _syscall_counters():
+    """Count calls to and elapsed seconds in each of _SYSCALLS.
+
+    The counters are a flat array, with the number of calls to the i'th
+    syscall at i and the elapsed time in it at _NSYSCALLS + i.
 
-    def __add__(self, other):  # noqa: D105
-        self.calls += 1
-        self.elapsed += other
+    """
+    return array.array("d", _NO_COUNTS)
 
 
 class Process(object):
     """Representation of a process.
 
-    This class is tightly coupled with Collapser, which manipulates it
-    and adds new fields as it processes.
+    This class is tightly coupled with Collapser, which manipulates its
+    fields as it processes.
+
+    A trace can contain tens of thousands of processes, so the fields are
+    declared as slots to avoid a dict per instance.
 
     """
 
+    __slots__ = (
+        "args",
+        "pid",
+        "parent",
+        "begin",
+        "end",
+        "retcode",
+        "child_samples",
+        "syscalls",
+        "_ancestors",
+        "_parent_str",
+        "_str",
+    )
+
     def __init__(self, pid, parent, begin):  # noqa: D107
         self.args = None
         self.pid = pid
         self.parent = parent
         self.begin = begin
         self.end = None
-        self.child_samples = timedelta(0)
+        self.retcode = None
+        self.child_samples = 0.0
+        # Cached result of __str__, which is costly to build, and the
+        # parent's stack it was built on.
+        self._str = None
+        self._parent_str = None
+        self.syscalls = _syscall_counters()
         if parent is not None:
-            # Attribute any of a child's syscalls to its parent.
-            self.syscalls = parent.syscalls
+            # Keep the whole ancestry around so finishing a process can
+            # charge its time to every ancestor without chasing parents.
+            self._ancestors = parent._ancestors + (parent,)
         else:
-            self.syscalls = defaultdict(SyscallCounter)
+            self._ancestors = ()
 
     def execve(self, args, ts):
         """When a process execs, detach it from the parent.
@@ -167,46 +286,55 @@ class Process(object):
         exec, for tracking.
 
         """
-        oldproc = copy.copy(self)
+        # Copy the slots across, which is much cheaper than copy.copy, and
+        # unlike naming each field can't miss one added later.
+        oldproc = Process.__new__(Process)
+        for name in Process.__slots__:
+            setattr(oldproc, name, getattr(self, name))
         oldproc.end = ts
         self.begin = ts
         self.end = None
         self.args = args
-        self.child_samples = timedelta(0)
-        self.syscalls = defaultdict(SyscallCounter)
+        self._str = None
+        self.child_samples = 0.0
+        self.syscalls = _syscall_counters()
         return oldproc
 
     @property
     def elapsed(self):  # noqa: D102
-        end = self.end if self.end is not None else datetime.now()
-        sumcalls = sum(
-            (counter.elapsed for counter in self.syscalls.values()),
-            timedelta(0),
-        )
+        end = self.end if self.end is not None else time.time()
+        sumcalls = sum(self.syscalls[_NSYSCALLS:])
         return (end - self.begin) - self.child_samples - sumcalls
 
     def __str__(self):  # noqa: D105
-        if self.parent is not None:
-            s = str(self.parent)
-        else:
-            s = ""
+        # Our stack sits under whatever our parent is running now, which
+        # changes if it execs again. Parents hand back the same cached
+        # string until then, so comparing it is cheap.
+        s = str(self.parent) if self.parent is not None else ""
+        if self._str is None or s != self._parent_str:
+            self._parent_str = s
+            self._str = self._format(s)
+        return self._str
+
+    def _format(self, s):
         # Many processes (like /bin/bash) aren't interesting just by process
         # name, so we include some information about its args in its frame.
         if self.args is not None:
-            arg0, argv = self.args.split(",", 1)
-            arg0 = eval(arg0)
-            argv = argv.lstrip()
+            m = _QUOTED_RE.match(self.args)
+            if m is not None:
+                arg0 = _unquote(m.group(1))
+                argv = self.args[m.end() :].lstrip(", ")
+            else:
+                arg0, argv = self.args.split(",", 1)
+                argv = argv.lstrip()
             if argv.startswith("["):
                 # argv is a list, let's try to process it like one.
                 argv = argv[: argv.rindex("]") + 1]
-                if argv[-4:] == "...]":
-                    # Last argument truncated, let's make this eval-able.
-                    argv = argv[:-4] + ', "..."]'
-                try:
-                    argv = eval(argv)
-                except Exception:
-                    # Couldn't eval, just take some content to identify it.
-                    argv = argv[:32]
+                truncated = argv.endswith("...]")
+                argv = [_unquote(arg) for arg in _QUOTED_RE.findall(argv)]
+                if truncated:
+                    # strace elides arguments past its limit.
+                    argv.append("...")
             # Must replace semicolons with something (since they're
             # flamegraph's separator), may as well choose 'z'.
             me = f"{arg0}({self.pid}) {argv}".replace(";", "z")
@@ -232,104 +360,111 @@ class Collapser(object):
 
     """
 
-    SYSCALLS = (
-        "open",
-        "openat",
-        "link",
-        "unlink",
-        "unlinkat",
-        "getcwd",
-        "chdir",
-        "mkdir",
-        "access",
-        "faccessat",
-        "lstat",
-        "stat",
-        "newfstatat",
-        "statfs",
-        "readlink",
-        "mount",
-        "read",
-        "write",
-        "connect",
-        "socket",
-        "bind",
-        "setsockopt",
-        "getsockopt",
-        "getsockname",
-        "getpeername",
-        "sendmmsg",
-        "recvmsg",
-        "recvfrom",
-        "sendto",
-    )
-
     def __init__(self):  # noqa: D107
+        # Maps each pid to its Process, or to the Process it was cloned
+        # from if it hasn't exec'd anything itself.
         self.pmap = {}
+        # Maps each pid to the syscall counters its calls are attributed
+        # to. A clone which hasn't exec'd counts into the image it was
+        # cloned from, even if that process has since exec'd again.
+        self.syscalls = {}
+        # (Process, stack string) for each process which has finished, in
+        # the order they finished.
         self.finished = []
 
     def process(self, pid):
-        """Get a Process if we know about it."""
+        """Get the Process a pid is attributed to, if we know about it."""
         return self.pmap.get(pid)
 
     def record_finished(self, proc):
         """Account for a process which is done."""
-        if proc.args is None:
-            # Processes without their own args are still threads in their
-            # parent thread group, we can skip counting them, since their
-            # syscalls are attributed to their parent and their elapsed time
-            # is too.
-            return
+        # Build the stack string now, while the process's ancestors still
+        # have the args they had when it ran. Its self time and syscall
+        # rows wait for render: descendants which outlive it still take
+        # their time out of it, and clones which never exec'd still count
+        # syscalls into it.
+        self.finished.append((proc, str(proc)))
         selftime = proc.elapsed
-        current = proc.parent
-        while current is not None:
-            current.child_samples += selftime
-            current = current.parent
-        self.finished.append(proc)
-
-    def handle_call(self, call):
-        """Consume strace calls into the process map."""
-        if call.func == "clone":
-            # We've seen a process get created, and assume we'll see it
-            # exec something later (in execve).
-            self.pmap[call.retcode] = Process(
-                call.retcode, self.process(call.pid), call.ts
-            )
-        elif call.func == "execve":
-            if call.retcode != 0:
-                # Ignore failed execs
-                return
-            proc = self.process(call.pid)
-            if proc is None:
-                # The first process in the tree won't have been cloned
-                # from anything, so create one to hold its information.
-                proc = self.pmap[call.pid] = Process(call.pid, None, call.ts)
-                proc.args = call.args
-            else:
-                oldproc = proc.execve(call.args, call.ts)
-                self.record_finished(oldproc)
-        elif call.func == "atexit":
-            # When a process exits, record the time it consumed, and
-            # subtract that self time from its parent processes to avoid
-            # double-counting samples.
-            proc = self.pmap.pop(call.pid)
-            proc.retcode = call.retcode
-            proc.end = call.ts
-            self.record_finished(proc)
-        elif call.func in self.SYSCALLS:
-            if call.func == "read" and call.args[1:7] == "<pipe:":
+        for ancestor in proc._ancestors:
+            ancestor.child_samples += selftime
+
+    def _handle_clone(self, pid, ts, args, retcode):
+        # We've seen a process (or thread) get created. Until it execs
+        # something, it's not interesting on its own, so its syscalls and
+        # time are attributed to the process it was cloned from.
+        self.pmap[retcode] = self.pmap.get(pid)
+        self.syscalls[retcode] = self.syscalls.get(pid)
+
+    def _handle_execve(self, pid, ts, args, retcode):
+        if retcode != 0:
+            # Ignore failed execs
+            return
+        proc = self.pmap.get(pid)
+        if proc is not None and proc.pid == pid:
+            oldproc = proc.execve(args.decode(), ts)
+            self.syscalls[pid] = proc.syscalls
+            self.record_finished(oldproc)
+        else:
+            # Either a clone of proc is exec'ing for the first time, or
+            # this is the first process in the tree, which wasn't cloned
+            # from anything. Either way it's now a process of its own.
+            proc = self.pmap[pid] = Process(pid, proc, ts)
+            proc.args = args.decode()
+            self.syscalls[pid] = proc.syscalls
+
+    def _handle_atexit(self, pid, ts, args, retcode):
+        # When a process exits, record the time it consumed, and subtract
+        # that self time from its parent processes to avoid double-counting
+        # samples.
+        proc = self.pmap.pop(pid)
+        del self.syscalls[pid]
+        if proc is None or proc.pid != pid:
+            # Never exec'd, so there's nothing of its own to record.
+            return
+        proc.retcode = retcode
+        proc.end = ts
+        self.record_finished(proc)
+
+    _HANDLERS = {
+        b"clone": _handle_clone,
+        b"execve": _handle_execve,
+        b"atexit": _handle_atexit,
+    }
+
+    def handle_call(self, pid, ts, func, args, retcode, status, elapsed):
+        """Consume a strace call into the process map.
+
+        Takes the fields of a Call, so a parsed Call can be passed as
+        ``handle_call(*call)``.
+
+        """
+        # Counted syscalls are the most common calls, so check them first.
+        i = _SYSCALL_INDEX.get(func)
+        if i is not None:
+            if func == b"read" and args.startswith(b"<pipe:", 1):
                 # Don't record the read time for pipes between processes
                 return
-            parent = self.process(call.pid)
-            if parent is not None:
-                counter = parent.syscalls[call.func]
-                counter += call.elapsed
+            counters = self.syscalls.get(pid)
+            if counters is not None:
+                counters[i] += 1
+                counters[_NSYSCALLS + i] += elapsed
+        else:
+            handler = self._HANDLERS.get(func)
+            if handler is not None:
+                handler(self, pid, ts, args, retcode)
+
+    def _lines(self):
+        for proc, stack in self.finished:
+            yield f"{stack} {max(1, round(proc.elapsed * 1000000))}\n"
+            counters = proc.syscalls
+            for i, func in enumerate(_SYSCALLS):
+                calls = counters[i]
+                if calls:
+                    us = round(counters[_NSYSCALLS + i] * 1000000)
+                    yield f"{stack};{func.decode()}({calls:.0f} calls) {us}\n"
 
     def render(self, f=sys.stdout):
         """Render flamegraph input based on our process map."""
-        for proc in self.finished:
-            us = max(1, int(proc.elapsed.total_seconds() * 1000000))
-            print(proc, us, file=f)
-            for func, counter in proc.syscalls.items():
-                us = int(counter.elapsed.total_seconds() * 1000000)
-                print(f"{proc};{func}({counter.calls} calls)", us, file=f)
+        # Write all the output at once, rather than paying for a print()
+        # per stack.
+        f.write("".join(self._lines()))
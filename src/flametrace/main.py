@@ -82,9 +82,8 @@ def _run_strace(mode, argv, output):
 def _collapse_stacks(strace_output, folded_output):
     parser = core.StraceParser()
     collapser = core.Collapser()
-    with open(strace_output, "r") as f:
-        for call in parser.parse(f):
-            collapser.handle_call(call)
+    with open(strace_output, "rb") as f:
+        parser.parse_into(f, collapser.handle_call)
     with open(folded_output, "w") as f:
         collapser.render(f)
 
@@ -0,0 +1,287 @@
+# Copyright (c) 2021, Leif Walsh
+# All Rights Reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# * Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+# * Neither the name of the <organization> nor the names of its contributors
+# may be used to endorse or promote products derived from this software
+# without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL <COPYRIGHT HOLDER> BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+#         SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+# OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH
+# DAMAGE.
+
+import io
+import os
+import tempfile
+from unittest import TestCase
+
+from flametrace.core import Call, Collapser, Process, StraceParser
+
+
+LINES = [
+    b'100   1610000000.000100 execve("/bin/sh", ["sh", "-c", "ls"], '
+    b"0x7ffc /* 20 vars */) = 0 <0.000200>",
+    b'100   1610000000.000200 chdir("/")            = 0 <0.000010>',
+    b'100   1610000000.000300 access("/etc/nope", F_OK) = -1 ENOENT '
+    b"(No such file or directory) <0.000005>",
+    b"100   1610000000.000400 wait4(-1,  <unfinished ...>",
+    b"101   1610000000.000500 exit_group(0)           = ?",
+    b"101   1610000000.000600 +++ exited with 0 +++",
+    b"100   1610000000.000700 <... wait4 resumed>NULL, 0, NULL) = 101 "
+    b"<0.000300>",
+    b"100   1610000000.000800 --- SIGCHLD {si_signo=SIGCHLD} ---",
+    b"102   1610000000.000900 +++ killed by SIGPIPE +++",
+]
+
+CALLS = [
+    Call(
+        100,
+        1610000000.0001,
+        b"execve",
+        b'"/bin/sh", ["sh", "-c", "ls"], 0x7ffc /* 20 vars */',
+        0,
+        None,
+        0.0002,
+    ),
+    Call(100, 1610000000.0002, b"chdir", b'"/"', 0, None, 0.00001),
+    Call(
+        100,
+        1610000000.0003,
+        b"access",
+        b'"/etc/nope", F_OK',
+        -1,
+        b"ENOENT (No such file or directory)",
+        0.000005,
+    ),
+    Call(101, 1610000000.0005, b"exit_group", b"0", b"?", None, 0.0),
+    Call(101, 1610000000.0006, b"atexit", None, 0, None, None),
+    Call(
+        100,
+        1610000000.0007,
+        b"wait4",
+        b"-1, NULL, 0, NULL",
+        101,
+        None,
+        0.0003,
+    ),
+    Call(
+        100,
+        1610000000.0008,
+        b"interrupt",
+        b"SIGCHLD",
+        b"{si_signo=SIGCHLD}",
+        None,
+        None,
+    ),
+    Call(102, 1610000000.0009, b"atexit", None, 128 + 13, None, None),
+]
+
+
+class StraceParserTests(TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix=".strace")
+        with os.fdopen(fd, "wb") as f:
+            f.write(b"\n".join(LINES) + b"\n")
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_parse_line(self):
+        parser = StraceParser()
+        calls = [parser.parse_line(line) for line in LINES]
+        self.assertEqual(CALLS, [call for call in calls if call is not None])
+
+    def test_parse_into(self):
+        calls = []
+        with open(self.path, "rb") as f:
+            StraceParser().parse_into(f, lambda *call: calls.append(call))
+        self.assertEqual(CALLS, calls)
+
+
+class ProcessTests(TestCase):
+    def test_execve(self):
+        proc = Process(100, None, 1.0)
+        proc.args = '"/bin/bash", ["bash"]'
+        str(proc)
+        oldproc = proc.execve('"/bin/foo", ["foo"]', 2.0)
+        for name in Process.__slots__:
+            if name not in ("begin", "end", "args", "_str", "syscalls"):
+                self.assertEqual(getattr(proc, name), getattr(oldproc, name))
+        self.assertEqual((1.0, 2.0), (oldproc.begin, oldproc.end))
+        self.assertEqual((2.0, None), (proc.begin, proc.end))
+        self.assertEqual("/bin/bash(100) ['bash']", str(oldproc))
+        self.assertEqual("/bin/foo(100) ['foo']", str(proc))
+
+    def frame(self, args):
+        proc = Process(100, None, 1.0)
+        proc.args = args
+        return str(proc)
+
+    def test_format(self):
+        self.assertEqual(
+            "/bin/ls(100) ['ls', '-l']",
+            self.frame('"/bin/ls", ["ls", "-l"], 0x7ffc /* 20 vars */'),
+        )
+
+    def test_format_escapes(self):
+        self.assertEqual(
+            """/bin/echo(100) ['echo', 'b"c', 'x\\x1by']""",
+            self.frame(r'"/bin/echo", ["echo", "b\"c", "x\33y"], 0x7ffc'),
+        )
+
+    def test_format_truncated(self):
+        # strace elides arguments past its limit, and the end of long
+        # arguments.
+        self.assertEqual(
+            "/bin/sh(100) ['sh', '-c', 'for i in', '...']",
+            self.frame('"/bin/sh", ["sh", "-c", "for i in"..., ...], 0x7ffc'),
+        )
+
+    def test_format_null_argv(self):
+        # Anything but a list is shown as strace printed it.
+        self.assertEqual(
+            "/bin/true(100) NULL, NULL", self.frame('"/bin/true", NULL, NULL')
+        )
+
+    def test_format_semicolons(self):
+        self.assertEqual(
+            "/bin/sh(100) ['sh', '-c', 'az b']",
+            self.frame('"/bin/sh", ["sh", "-c", "a; b"], 0x7ffc'),
+        )
+
+
+def execve(pid, ts, *argv):
+    args = ", ".join(f'"{arg}"' for arg in argv)
+    return (
+        f'{pid}   {ts} execve("/bin/{argv[0]}", [{args}], '
+        f"0x7ffc /* 20 vars */) = 0 <0.000100>"
+    ).encode()
+
+
+def clone(pid, ts, child):
+    return (
+        f"{pid}   {ts} clone(child_stack=NULL, flags=SIGCHLD) = {child} "
+        f"<0.000050>"
+    ).encode()
+
+
+def openat(pid, ts, elapsed):
+    return (
+        f'{pid}   {ts} openat(AT_FDCWD, "/etc/passwd", O_RDONLY) = 3 '
+        f"<{elapsed}>"
+    ).encode()
+
+
+def exit(pid, ts):
+    return f"{pid}   {ts} +++ exited with 0 +++".encode()
+
+
+class CollapserTests(TestCase):
+    def collapse(self, lines):
+        collapser = Collapser()
+        with tempfile.TemporaryFile() as f:
+            f.write(b"\n".join(lines) + b"\n")
+            f.seek(0)
+            StraceParser().parse_into(f, collapser.handle_call)
+        out = io.StringIO()
+        collapser.render(out)
+        return out.getvalue().splitlines()
+
+    def test_child_outlives_parent(self):
+        # A child which is still running when its parent exits still takes
+        # its time out of the parent's.
+        lines = self.collapse(
+            [
+                execve(100, "1610000000.000000", "bash"),
+                clone(100, "1610000000.000200", 101),
+                execve(101, "1610000000.000400", "sleep", "1"),
+                exit(100, "1610000000.001000"),
+                exit(101, "1610000000.001200"),
+            ]
+        )
+        self.assertEqual(
+            [
+                "/bin/bash(100) ['bash'] 200",
+                "/bin/bash(100) ['bash'];/bin/sleep(101) ['sleep', '1'] 800",
+            ],
+            lines,
+        )
+
+    def test_clone_outlives_parent(self):
+        # A subshell which keeps running after its shell exits still has
+        # its syscalls counted under the shell.
+        lines = self.collapse(
+            [
+                execve(100, "1610000000.000000", "bash"),
+                openat(100, "1610000000.000200", "0.000020"),
+                clone(100, "1610000000.000300", 101),
+                exit(100, "1610000000.001000"),
+                openat(101, "1610000000.001100", "0.000500"),
+                exit(101, "1610000000.001800"),
+            ]
+        )
+        self.assertEqual(
+            [
+                "/bin/bash(100) ['bash'] 480",
+                "/bin/bash(100) ['bash'];openat(2 calls) 520",
+            ],
+            lines,
+        )
+
+    def test_clone_keeps_image_across_exec(self):
+        # A child forked before its parent execs counts its syscalls
+        # under the parent's old image, not the program it execs.
+        lines = self.collapse(
+            [
+                execve(100, "1610000000.000000", "bash"),
+                clone(100, "1610000000.000200", 101),
+                execve(100, "1610000000.000300", "foo"),
+                openat(101, "1610000000.000400", "0.000100"),
+                exit(101, "1610000000.001000"),
+                exit(100, "1610000000.001200"),
+            ]
+        )
+        self.assertEqual(
+            [
+                "/bin/bash(100) ['bash'] 200",
+                "/bin/bash(100) ['bash'];openat(1 calls) 100",
+                "/bin/foo(100) ['foo'] 900",
+            ],
+            lines,
+        )
+
+    def test_parent_execs_again(self):
+        # A child which finishes after its parent execs something else is
+        # charged to, and shown under, what the parent is running then.
+        lines = self.collapse(
+            [
+                execve(100, "1610000000.000000", "bash"),
+                clone(100, "1610000000.000100", 101),
+                execve(101, "1610000000.000200", "sleep", "1"),
+                execve(100, "1610000000.000400", "foo"),
+                exit(101, "1610000000.100200"),
+                exit(100, "1610000000.200300"),
+            ]
+        )
+        self.assertEqual(
+            [
+                "/bin/bash(100) ['bash'] 400",
+                "/bin/foo(100) ['foo'];/bin/sleep(101) ['sleep', '1'] 100000",
+                "/bin/foo(100) ['foo'] 99900",
+            ],
+            lines,
+        )